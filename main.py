@@ -1,7 +1,12 @@
-from fastapi import FastAPI, HTTPException
+from fastapi import FastAPI, HTTPException, Response
 from pydantic import BaseModel
-import json
-import time
+import asyncio
+import ctypes
+import ctypes.util
+import orjson
+import struct
+import sys
+import uuid
 import os
 
 app = FastAPI(
@@ -18,6 +23,33 @@ TRANSLATION_OUTPUT = "translation_output.json"
 BACKEND_INPUT = "lookup_input.json"
 BACKEND_OUTPUT = "lookup_output.json"
 
+# Seconds a request waits at each stage, including time queued for the stage
+HANDOFF_TIMEOUT = 10
+
+# inotify (Linux only) so waiting on the other teams doesn't poll the disk.
+# Other platforms fall back to polling.
+
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_TO = 0x00000080
+INOTIFY_EVENT = struct.Struct("iIII")
+
+_libc = None
+if sys.platform.startswith("linux"):
+    try:
+        _libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+    except OSError:
+        _libc = None
+
+# Result queues of /process calls waiting on a reply, keyed by "<stage>:<request_id>"
+
+_pending = {}
+FILE_READY = object()
+
+# Every request shares the same handoff files, so only one request at a
+# time may use each stage's input/output pair
+
+_handoff_locks = {"translation": asyncio.Lock(), "lookup": asyncio.Lock()}
+
 
 #Models for initial input and final output
 
@@ -36,28 +68,171 @@ class FinalOutput(BaseModel):
 
 
 #Helper functions
+#File I/O is blocking, async code runs these through asyncio.to_thread
 
+#Writes to a temp file then renames it over path, so the other teams
+#never see a half written file
 def write_json(path, data):
-    with open(path, "w") as f:
-        json.dump(data, f, indent=2)
+    # Each write gets its own temp name so concurrent writers don't collide
+    tmp = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with open(tmp, "wb") as f:
+            f.write(orjson.dumps(data))
+        os.replace(tmp, path)
+    except BaseException:
+        remove_file(tmp)
+        raise
+
+
+#Deletes path, ignoring it if already gone
+def remove_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
 
 
 def read_json(path):
-    with open(path, "r") as f:
-        return json.load(f)
+    with open(path, "rb") as f:
+        return orjson.loads(f.read())
+
+#Open an inotify watch on the directory holding path, None if unavailable
+def open_watch(path):
+    if _libc is None:
+        return None
+
+    fd = _libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if fd < 0:
+        return None
+
+    directory = os.path.dirname(os.path.abspath(path)).encode()
+    if _libc.inotify_add_watch(fd, directory, IN_CLOSE_WRITE | IN_MOVED_TO) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+#Names of the files from a batch of inotify events
+def read_inotify_names(fd):
+    buf = os.read(fd, 4096)
+    names = []
+    offset = 0
+    while offset < len(buf):
+        _, _, _, length = INOTIFY_EVENT.unpack_from(buf, offset)
+        offset += INOTIFY_EVENT.size
+        names.append(buf[offset:offset + length].rstrip(b"\0"))
+        offset += length
+    return names
+
+
+#Polling fallback for when inotify is unavailable
+#Signals every new version of the file, not just the first one
+async def poll_for_file(path, results):
+    seen = None
+    while True:
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            seen = None
+        else:
+            if (st.st_ino, st.st_mtime_ns) != seen:
+                seen = (st.st_ino, st.st_mtime_ns)
+                results.put_nowait(FILE_READY)
+        await asyncio.sleep(0.1)
+
 
 #Wait function for time between responses othherwise timeout
-def wait_for_json(path, timeout=10):
-    start = time.time()
-    while not os.path.exists(path):
-        if time.time() - start > timeout:
-            raise TimeoutError(f"Timed out waiting for {path}")
-        time.sleep(0.1)
-    return read_json(path)
+#Takes the first result from the team POSTing to the result endpoint, or
+#from the file being closed after writing / renamed into place.
+#Files answering a different request_id are skipped, the one used is removed
+async def wait_for_json(path, timeout=10, results=None, request_id=None):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    if results is None:
+        results = asyncio.Queue()
+
+    name = os.path.basename(path).encode()
+    fd = open_watch(path)
+    poller = None
+
+    def on_event():
+        if name in read_inotify_names(fd):
+            results.put_nowait(FILE_READY)
+
+    if fd is not None:
+        loop.add_reader(fd, on_event)
+        # Checked after the watch is added so a file written in between isn't missed
+        if os.path.exists(path):
+            results.put_nowait(FILE_READY)
+    else:
+        poller = asyncio.create_task(poll_for_file(path, results))
+
+    try:
+        while True:
+            try:
+                result = await asyncio.wait_for(results.get(), deadline - loop.time())
+            except asyncio.TimeoutError:
+                raise TimeoutError(f"Timed out waiting for {path}")
+
+            if result is not FILE_READY:
+                return result
+
+            try:
+                result = await asyncio.to_thread(read_json, path)
+            except FileNotFoundError:
+                continue
+
+            # Replies without a request_id are from teams that don't echo it yet
+            if request_id is None or result.get("request_id", request_id) == request_id:
+                await asyncio.to_thread(remove_file, path)
+                return result
+    finally:
+        if fd is not None:
+            loop.remove_reader(fd)
+            os.close(fd)
+        if poller is not None:
+            poller.cancel()
+
+
+#Writes the input file for one stage and waits for that team's reply
+async def handoff(stage, request_id, input_path, data, output_path, timeout=10):
+    key = f"{stage}:{request_id}"
+    results = asyncio.Queue()
+    lock = _handoff_locks[stage]
+
+    # One deadline covers waiting in the queue for the stage and for the reply
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + timeout
+    try:
+        await asyncio.wait_for(lock.acquire(), timeout)
+    except asyncio.TimeoutError:
+        raise TimeoutError(f"Timed out waiting for {output_path}")
+
+    try:
+        _pending[key] = results
+        # Clears out any reply left over from an earlier request
+        await asyncio.to_thread(remove_file, output_path)
+        await asyncio.to_thread(write_json, input_path, data)
+        return await wait_for_json(output_path, deadline - loop.time(), results, request_id)
+    finally:
+        _pending.pop(key, None)
+        lock.release()
+
+
+#Hands a POSTed result to the /process call waiting on key
+def deliver_result(key, payload):
+    results = _pending.get(key)
+    if results is None:
+        raise HTTPException(404, "No pending request with that id")
+    results.put_nowait(payload)
+    return {"received": True}
+
 
 #Sarting Point
-@app.post("/process", response_model=FinalOutput)
-def process_medication(data: UserInput):
+# FinalOutput only documents the response, the body is encoded with orjson
+# directly so it isn't validated against the model a second time
+@app.post("/process", response_model=None, responses={200: {"model": FinalOutput}})
+async def process_medication(data: UserInput):
 
     # Ensures the Original Request has filled out fields
     # Expected Fields: original_language, requested_language, original_medication
@@ -70,18 +245,20 @@ def process_medication(data: UserInput):
     if not data.original_medication.strip():
         raise HTTPException(400, "Original medication cannot be empty")
 
+    # Id the other teams use to POST results back to the result endpoints
+    request_id = uuid.uuid4().hex
+
     # Reformats and sets standard for json input/output
     translation_input = {
+        "request_id": request_id,
         "original_language": data.original_language.strip(),
         "requested_language": data.requested_language.strip(),
         "original_medication": data.original_medication.strip()
     }
 
-    write_json(TRANSLATION_INPUT, translation_input)
-
-    # Waits for translation output
+    # Sends to the translation program and waits for its output
     try:
-        translation_output = wait_for_json(TRANSLATION_OUTPUT)
+        translation_output = await handoff("translation", request_id, TRANSLATION_INPUT, translation_input, TRANSLATION_OUTPUT, HANDOFF_TIMEOUT)
     except TimeoutError as e:
         raise HTTPException(500, str(e))
 
@@ -99,16 +276,15 @@ def process_medication(data: UserInput):
 
     # Cleans up the Translation json, removing any unnecessary verification info
     cleaned_translation = {
+        "request_id": request_id,
         "translated_medication": translated_medication.strip(),
         "requested_language": data.requested_language,
         "original_medication": data.original_medication,
     }
 
-    write_json(BACKEND_INPUT, cleaned_translation)
-
-    #Waits for Database lookup
+    #Sends to the Database lookup and waits for its output
     try:
-        lookup_output = wait_for_json(BACKEND_OUTPUT)
+        lookup_output = await handoff("lookup", request_id, BACKEND_INPUT, cleaned_translation, BACKEND_OUTPUT, HANDOFF_TIMEOUT)
     except TimeoutError as e:
         raise HTTPException(500, str(e))
 
@@ -133,10 +309,22 @@ def process_medication(data: UserInput):
     ]
 
     # Final Return
-    return {
+    final_output = {
         "original_language": data.original_language,
         "requested_language": data.requested_language,
         "original_medication": data.original_medication,
         "translated_medication": translated_medication,
         "medication_matches": final_matches
-    }
\ No newline at end of file
+    }
+    return Response(orjson.dumps(final_output), media_type="application/json")
+
+
+#Result endpoints, teams can POST here instead of writing the output JSONs
+@app.post("/translation_result/{request_id}")
+async def translation_result(request_id: str, payload: dict):
+    return deliver_result(f"translation:{request_id}", payload)
+
+
+@app.post("/lookup_result/{request_id}")
+async def lookup_result(request_id: str, payload: dict):
+    return deliver_result(f"lookup:{request_id}", payload)
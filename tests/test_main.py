@@ -0,0 +1,166 @@
+import asyncio
+import os
+import threading
+import time
+
+import httpx
+import pytest
+
+import main
+
+
+def test_write_json_concurrent_writers(tmp_path):
+    path = str(tmp_path / "translation_input.json")
+    errors = []
+
+    def writer(n):
+        try:
+            for i in range(200):
+                main.write_json(path, {"writer": n, "i": i})
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=writer, args=(n,)) for n in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    assert errors == []
+    assert main.read_json(path)["i"] == 199
+    assert os.listdir(tmp_path) == ["translation_input.json"]
+
+
+def test_write_json_cleans_up_temp_file_on_failure(tmp_path):
+    path = str(tmp_path / "lookup_input.json")
+    with pytest.raises(TypeError):
+        main.write_json(path, {"bad": object()})
+
+    assert os.listdir(tmp_path) == []
+
+
+REQUEST = {"original_language": "en", "requested_language": "es", "original_medication": "ibuprofen"}
+TRANSLATION = {"translated_medication": "ibuprofeno"}
+LOOKUP = {"success": True, "matches": [{"generic": "ibuprofen", "brand": "Advil"}]}
+
+
+@pytest.fixture(autouse=True)
+def handoff_dir(tmp_path, monkeypatch):
+    # Handoff files live in the working directory, locks are bound to one event loop
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(main, "_handoff_locks", {"translation": asyncio.Lock(), "lookup": asyncio.Lock()})
+    main._pending.clear()
+
+
+#Stands in for the translation and lookup programs, answering each new input
+#either by POSTing to the result endpoints or by writing the output file
+async def fake_teams(client, reply_by, count):
+    answered = set()
+    stages = (
+        ("translation", main.TRANSLATION_INPUT, main.TRANSLATION_OUTPUT, TRANSLATION),
+        ("lookup", main.BACKEND_INPUT, main.BACKEND_OUTPUT, LOOKUP),
+    )
+    while len(answered) < count * 2:
+        for stage, input_path, output_path, reply in stages:
+            try:
+                request_id = main.read_json(input_path)["request_id"]
+            except FileNotFoundError:
+                continue
+            if (stage, request_id) in answered:
+                continue
+            answered.add((stage, request_id))
+
+            if reply_by == "post":
+                response = await client.post(f"/{stage}_result/{request_id}", json=reply)
+                assert response.status_code == 200
+            else:
+                main.write_json(output_path, dict(reply, request_id=request_id))
+        await asyncio.sleep(0.01)
+
+
+async def run_requests(reply_by, count):
+    transport = httpx.ASGITransport(app=main.app)
+    async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+        teams = asyncio.create_task(fake_teams(client, reply_by, count))
+        try:
+            return await asyncio.gather(*[client.post("/process", json=REQUEST) for _ in range(count)])
+        finally:
+            teams.cancel()
+
+
+def assert_all_ok(responses):
+    for response in responses:
+        assert response.status_code == 200, response.text
+        body = response.json()
+        assert body["translated_medication"] == "ibuprofeno"
+        assert body["medication_matches"] == [{"generic": "ibuprofen", "brand": "Advil"}]
+
+
+def test_process_concurrent_post_callbacks():
+    assert_all_ok(asyncio.run(run_requests("post", 5)))
+    assert main._pending == {}
+
+
+@pytest.mark.skipif(main._libc is None, reason="inotify is Linux only")
+def test_process_concurrent_output_files_inotify():
+    assert_all_ok(asyncio.run(run_requests("file", 5)))
+    assert not os.path.exists(main.TRANSLATION_OUTPUT)
+    assert not os.path.exists(main.BACKEND_OUTPUT)
+
+
+def test_process_output_files_polling(monkeypatch):
+    monkeypatch.setattr(main, "_libc", None)
+    assert_all_ok(asyncio.run(run_requests("file", 2)))
+
+
+def test_wait_for_json_skips_reply_for_other_request():
+    async def scenario():
+        results = asyncio.Queue()
+        waiter = asyncio.create_task(main.wait_for_json("out.json", 5, results, "mine"))
+        await asyncio.sleep(0.05)
+        main.write_json("out.json", {"request_id": "someone-else"})
+        await asyncio.sleep(0.05)
+        assert not waiter.done()
+        main.write_json("out.json", {"request_id": "mine", "value": 1})
+        return await waiter
+
+    assert asyncio.run(scenario()) == {"request_id": "mine", "value": 1}
+    assert not os.path.exists("out.json")
+
+
+def test_process_ignores_stale_output_file():
+    main.write_json(main.TRANSLATION_OUTPUT, {"translated_medication": "stale"})
+    assert_all_ok(asyncio.run(run_requests("post", 1)))
+
+
+def test_result_for_unknown_request_is_404():
+    async def scenario():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            return await client.post("/translation_result/unknown", json=TRANSLATION)
+
+    assert asyncio.run(scenario()).status_code == 404
+
+
+def test_queued_requests_time_out_within_timeout(monkeypatch):
+    monkeypatch.setattr(main, "HANDOFF_TIMEOUT", 1)
+
+    async def scenario():
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://test") as client:
+            async def timed_request():
+                start = time.monotonic()
+                response = await client.post("/process", json=REQUEST)
+                return response, time.monotonic() - start
+
+            return await asyncio.gather(*[timed_request() for _ in range(3)])
+
+    for response, elapsed in asyncio.run(scenario()):
+        assert response.status_code == 500
+        assert response.json()["detail"] == "Timed out waiting for translation_output.json"
+        assert elapsed < 1.5
+
+
+def test_wait_for_json_times_out():
+    with pytest.raises(TimeoutError):
+        asyncio.run(main.wait_for_json("never.json", timeout=0.2))